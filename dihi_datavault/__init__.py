@@ -1,70 +1,322 @@
+import base64
+import contextlib
+import functools
 import hashlib
+import hmac
 import json
+import mmap
 import os
-import struct
+import stat
 import sys
+import tempfile
 import textwrap
-from fnmatch import fnmatch
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Union
-
-import cryptography
-from cryptography.fernet import Fernet
+from typing import (
+    BinaryIO,
+    Dict,
+    FrozenSet,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives.ciphers import Cipher
+from cryptography.hazmat.primitives.ciphers.algorithms import AES
+from cryptography.hazmat.primitives.ciphers.modes import CTR
+from cryptography.hazmat.primitives.hashes import SHA256
+from cryptography.hazmat.primitives.hmac import HMAC
 
 if sys.version_info < (3, 8):
     TypedDict = dict
 else:
     from typing import TypedDict
 
+# orjson is optional; it speeds up reading and writing large manifests
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 __version__ = "0.1.0"
 
+# Sizes of the random CTR nonce and the HMAC-SHA256 trailer in encrypted files
+NONCE_SIZE = 16
+TAG_SIZE = 32
+
+# Prefix of the temporary files written next to vault files. Listings skip
+# them, so one left behind by an interrupted run is never taken for data.
+TMP_PREFIX = ".datavault-"
+
+
+def _current_umask() -> int:
+    """
+    Returns the process umask. It can only be read by setting it, so this is
+    done once at import rather than from the worker threads.
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+UMASK = _current_umask()
+
 #
 # Helpers
 #
 
 
+def thread_pool() -> ThreadPoolExecutor:
+    """
+    Returns a thread pool for running independent per-file work concurrently.
+
+    The crypto and hashing primitives release the GIL, so threads overlap
+    both the compute and the blocking file I/O.
+    """
+    return ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 2))
+
+
+def advise_sequential(f) -> None:
+    """
+    Hints to the kernel that a file will be read front to back so it can
+    read ahead aggressively. This is a no-op where posix_fadvise is missing.
+    """
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+
+@contextlib.contextmanager
+def atomic_write(path: Union[str, Path]) -> Iterator[BinaryIO]:
+    """
+    Opens a temporary file next to `path` for writing and moves it over
+    `path` once the block completes, so `path` is never left half-written.
+
+    The temporary file gets a unique name starting with TMP_PREFIX, so it
+    can't collide with another vault file or a concurrent write. It takes
+    the mode of the file it replaces, or the mode `open` would give a new
+    file, instead of mkstemp's 0600.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=TMP_PREFIX)
+    try:
+        try:
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+        except FileNotFoundError:
+            mode = 0o666 & ~UMASK
+        os.chmod(tmp, mode)
+        with os.fdopen(fd, "wb") as f:
+            yield f
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def hash_for_file(filepath):
+    """
+    Returns the hex digest used to detect changes to a file.
+
+    BLAKE2b is faster than MD5 on 64-bit machines and ships with hashlib.
+    The file is memory-mapped and hashed in place, which avoids copying it
+    into userspace and keeps memory use flat for large files.
+    """
+    return _digest_file(filepath, functools.partial(hashlib.blake2b, digest_size=32))
+
+
 def md5_hash_for_file(filepath):
-    return hashlib.md5(open(filepath, "rb").read()).hexdigest()
+    """
+    Returns the MD5 hex digest that version 1 manifests record for a file.
+    """
+    return _digest_file(filepath, hashlib.md5)
+
+
+def _digest_file(filepath, new_hash) -> str:
+    """
+    Returns the hex digest of a memory-mapped file using the given hashlib
+    constructor.
+    """
+    with open(filepath, "rb") as f:
+        # Empty files can't be mapped
+        if os.fstat(f.fileno()).st_size == 0:
+            return new_hash().hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                m.madvise(mmap.MADV_SEQUENTIAL)
+            return new_hash(m).hexdigest()
+
+
+def read_json(path: Union[str, Path]):
+    """
+    Reads a JSON file, using orjson when it is installed.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+def write_json(path: Union[str, Path], data) -> None:
+    """
+    Atomically writes a JSON file with sorted keys so it diffs cleanly. The
+    output is byte-for-byte the same whether or not orjson is installed.
+    """
+    if orjson:
+        encoded = orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS)
+    else:
+        encoded = json.dumps(data, indent=2, sort_keys=True, ensure_ascii=False).encode(
+            "utf-8"
+        )
+    with atomic_write(path) as f:
+        f.write(encoded)
+
+
+class VaultKey(NamedTuple):
+    """
+    The signing and encryption halves of a vault secret. Decode it once with
+    `VaultKey.from_secret` and pass it to `encrypt`/`decrypt` to reuse it
+    across files.
+    """
+
+    signing_key: bytes
+    encryption_key: bytes
+
+    @staticmethod
+    def from_secret(secret: Union[str, "VaultKey"]) -> "VaultKey":
+        """
+        Splits a Fernet key into its signing and encryption halves.
+
+        :param secret: The url-safe base64 encoded 32-byte key, or an
+            already decoded VaultKey which is returned as is
+        """
+        if isinstance(secret, VaultKey):
+            return secret
+        raw = base64.urlsafe_b64decode(secret)
+        if len(raw) != 32:
+            raise ValueError("Key must be 32 url-safe base64-encoded bytes.")
+        return VaultKey(raw[:16], raw[16:])
+
+
+def _stream_buffers(block: int) -> Tuple[memoryview, memoryview]:
+    """
+    Returns reusable input and output buffers for streaming `block` bytes at
+    a time through a cipher. update_into needs room for one extra AES block.
+    """
+    return memoryview(bytearray(block)), memoryview(bytearray(block + 15))
 
 
-def encrypt(key: str, fin: Union[str, Path], fout: Union[str, Path], *, block=1 << 16):
+def encrypt(
+    key: Union[str, VaultKey],
+    fin: Union[str, Path],
+    fout: Union[str, Path],
+    *,
+    block=1 << 20,
+):
     """
-    Encrypts a file in chunks to support large file sizes.
+    Encrypts a file in a single streaming pass to support large file sizes.
+
+    The output is laid out as `nonce || ciphertext || tag`, where the
+    ciphertext is AES-128-CTR and the tag is an HMAC-SHA256 over the nonce
+    and ciphertext. The key halves are used the same way Fernet uses them.
+    It is written atomically, so an existing `fout` is never left
+    half-written.
 
     :param key: The key to use for encryption
     :param fin: The file to encrypt
     :param fout: The encrypted file to write to
     """
-    fernet = cryptography.fernet.Fernet(key)
-    with open(fin, "rb") as fi, open(fout, "wb") as fo:
+    signing_key, encryption_key = VaultKey.from_secret(key)
+    nonce = os.urandom(NONCE_SIZE)
+    encryptor = Cipher(AES(encryption_key), CTR(nonce)).encryptor()
+    h = HMAC(signing_key, SHA256())
+    h.update(nonce)
+    chunk, ct = _stream_buffers(block)
+    with open(fin, "rb", buffering=0) as fi, atomic_write(fout) as fo:
+        advise_sequential(fi)
+        fo.write(nonce)
         while True:
-            chunk = fi.read(block)
-            if len(chunk) == 0:
-                break
-            enc = fernet.encrypt(chunk)
-            fo.write(struct.pack("<I", len(enc)))
-            fo.write(enc)
-            if len(chunk) < block:
+            n = fi.readinto(chunk)
+            if not n:
                 break
+            n = encryptor.update_into(chunk[:n], ct)
+            h.update(ct[:n])
+            fo.write(ct[:n])
+        ct = encryptor.finalize()
+        h.update(ct)
+        fo.write(ct)
+        fo.write(h.finalize())
+
+
+def decrypt(
+    key: Union[str, VaultKey],
+    fin: Union[str, Path],
+    fout: Union[str, Path],
+    *,
+    block=1 << 20,
+):
+    """
+    Decrypts a file in a single streaming pass to support large file sizes.
 
+    The output is written to a temporary file and the tag is checked once
+    the whole file has been read. Only authentic plaintext is moved to
+    `fout`; otherwise `InvalidToken` is raised and `fout` is left untouched.
 
-def decrypt(key: str, fin: Union[str, Path], fout: Union[str, Path]):
+    :param key: The key to use for decryption
+    :param fin: The encrypted file to decrypt
+    :param fout: The decrypted file to write to
     """
-    Decrypts a file in chunks to support large file sizes.
+    signing_key, encryption_key = VaultKey.from_secret(key)
+    remaining = os.path.getsize(fin) - NONCE_SIZE - TAG_SIZE
+    if remaining < 0:
+        raise InvalidToken(f"Encrypted file is truncated: {fin}")
+
+    ct, chunk = _stream_buffers(block)
+    with open(fin, "rb", buffering=0) as fi, atomic_write(fout) as fo:
+        advise_sequential(fi)
+        nonce = fi.read(NONCE_SIZE)
+        decryptor = Cipher(AES(encryption_key), CTR(nonce)).decryptor()
+        h = HMAC(signing_key, SHA256())
+        h.update(nonce)
+        while remaining > 0:
+            n = fi.readinto(ct[: min(block, remaining)])
+            if not n:
+                break
+            remaining -= n
+            h.update(ct[:n])
+            n = decryptor.update_into(ct[:n], chunk)
+            fo.write(chunk[:n])
+        fo.write(decryptor.finalize())
+        # Raising here discards the temporary file before it replaces fout
+        if not hmac.compare_digest(h.finalize(), fi.read(TAG_SIZE)):
+            raise InvalidToken(f"Encrypted file is corrupt or the key is wrong: {fin}")
+
+
+def decrypt_v1(
+    key: Union[str, VaultKey], fin: Union[str, Path], fout: Union[str, Path]
+):
+    """
+    Decrypts a file written by a version 1 vault, which stored it as a
+    series of Fernet tokens each prefixed with its little-endian length.
+
+    This is only kept so older vaults can be decrypted and then encrypted
+    again in the current format.
 
     :param key: The key to use for decryption
     :param fin: The encrypted file to decrypt
     :param fout: The decrypted file to write to
     """
-    fernet = cryptography.fernet.Fernet(key)
-    with open(fin, "rb") as fi, open(fout, "wb") as fo:
+    signing_key, encryption_key = VaultKey.from_secret(key)
+    fernet = Fernet(base64.urlsafe_b64encode(signing_key + encryption_key))
+    with open(fin, "rb") as fi, atomic_write(fout) as fo:
         while True:
             size_data = fi.read(4)
             if len(size_data) == 0:
                 break
-            chunk = fi.read(struct.unpack("<I", size_data)[0])
-            dec = fernet.decrypt(chunk)
-            fo.write(dec)
+            if len(size_data) < 4:
+                raise InvalidToken(f"Encrypted file is truncated: {fin}")
+            fo.write(fernet.decrypt(fi.read(int.from_bytes(size_data, "little"))))
 
 
 class VaultManifest(TypedDict):
@@ -94,9 +346,17 @@ class VaultChangeSet(TypedDict):
 
 
 class DataVault:
-    VERSION = 1
+    VERSION = 2
+    # Manifest versions that can be read; older ones are upgraded to VERSION
+    # the next time the vault is encrypted
+    SUPPORTED_VERSIONS = (1, 2)
     MANIFEST_FILENAME = "vault_manifest.json"
+    # Records the stat and hash of each decrypted file on this machine. It
+    # lives in the vault root, so the vault's .gitignore keeps it out of git.
+    STAT_CACHE_FILENAME = ".datavault_stat.json"
     ENCRYPTED_NAMESPACE = ".encrypted"
+    # Directories that never hold vaults and are expensive to search
+    SKIP_DIRECTORIES = {".git", "node_modules", "__pycache__"}
 
     @staticmethod
     def find_all(path: Union[str, Path]) -> List["DataVault"]:
@@ -106,33 +366,64 @@ class DataVault:
         # Search path for vault manifests
         manifest_paths = [
             path
-            for path in Path(path).rglob(
-                f"{DataVault.ENCRYPTED_NAMESPACE}/{DataVault.MANIFEST_FILENAME}"
-            )
+            for path in DataVault._find_manifests(path)
             if DataVault._verify_manifest(path)
         ]
         vault_dirs = [Path(path).parent.parent for path in manifest_paths]
         vaults = [DataVault(path) for path in sorted(vault_dirs)]
         return vaults
 
+    @staticmethod
+    def _find_manifests(path: Union[str, Path]) -> Iterator[Path]:
+        """
+        Yields the paths of all vault manifests under the given path.
+
+        Walks the tree with os.scandir, which reuses the directory entry
+        types instead of stat'ing every path, and doesn't descend into
+        symlinks or the directories in SKIP_DIRECTORIES.
+        """
+        pending = [os.fspath(path)]
+        while pending:
+            try:
+                entries = os.scandir(pending.pop())
+            except OSError:
+                continue
+            with entries:
+                for entry in entries:
+                    if not entry.is_dir(follow_symlinks=False):
+                        continue
+                    if entry.name in DataVault.SKIP_DIRECTORIES:
+                        continue
+                    if entry.name == DataVault.ENCRYPTED_NAMESPACE:
+                        manifest_path = Path(entry.path) / DataVault.MANIFEST_FILENAME
+                        if manifest_path.is_file():
+                            yield manifest_path
+                    pending.append(entry.path)
+
     @staticmethod
     def _verify_manifest(vault_manifest_path: Union[str, Path]) -> bool:
         """
         Verifies that the vault manifest is valid.
         """
         try:
-            with open(vault_manifest_path, "r") as f:
-                manifest = json.load(f)
+            manifest = read_json(vault_manifest_path)
         except Exception as e:
             return False
 
+        return DataVault._valid_manifest(manifest)
+
+    @staticmethod
+    def _valid_manifest(manifest: VaultManifest) -> bool:
+        """
+        Verifies that the parsed vault manifest is valid.
+        """
         if not isinstance(manifest.get("_"), str):
             return False
 
         if not isinstance(manifest.get("files"), dict):
             return False
 
-        return manifest.get("version") == DataVault.VERSION
+        return isinstance(manifest.get("version"), int)
 
     @staticmethod
     def generate_secret() -> str:
@@ -152,6 +443,9 @@ class DataVault:
         self.root_path = Path(path)
         self.encrypted_path = self.root_path / DataVault.ENCRYPTED_NAMESPACE
         self.vault_manifest_path = self.encrypted_path / DataVault.MANIFEST_FILENAME
+        self.stat_cache_path = self.root_path / DataVault.STAT_CACHE_FILENAME
+        # The parsed manifest and its file names, keyed by the manifest's stat
+        self._manifest_cache = None
 
     def create(self) -> str:
         """
@@ -168,43 +462,109 @@ class DataVault:
         self._reset_manifest()
         self._verify_or_explode()
 
-    def encrypt(self, secret_key: str) -> None:
+    def encrypt(
+        self,
+        secret_key: str,
+        rehash: bool = False,
+        next_manifest: Optional[VaultManifest] = None,
+    ) -> None:
         """
         Encrypts all decrypted files in the data vault that have changed
         since the last encryption.
+
+        Pass `rehash=True` to hash every file rather than trusting
+        unchanged modification times and sizes. Pass a `next_manifest` from
+        `next_manifest()` to reuse its hashes instead of hashing again.
         """
+        # Decode the key once for every file rather than per file
+        key = VaultKey.from_secret(secret_key)
         self._create_gitignore()  # Just in case
         self._verify_or_explode()
 
-        changes = self.changes()
+        # Hash the vault once for both the change set and the new manifest
+        if next_manifest is None:
+            next_manifest = self._next_manifest(rehash)
+        changes = self._changes(next_manifest)
+        files = changes["additions"] + changes["updates"]
 
-        for f in changes["additions"]:
-            encrypt(secret_key, self.root_path / f, self.encrypted_path / f)
+        if self.is_legacy():
+            # Upgrade an older vault by encrypting every file in the current
+            # format and recording the current hashes
+            files = list(next_manifest["files"])
+            next_manifest = self._next_manifest(rehash=True, version=self.VERSION)
 
-        for f in changes["updates"]:
-            os.remove(os.path.join(self.encrypted_path, f))
-            encrypt(secret_key, self.root_path / f, self.encrypted_path / f)
+        # Updates are replaced atomically so they don't need removing first
+        tasks = [(self.root_path / f, self.encrypted_path / f) for f in files]
+        with thread_pool() as executor:
+            # Consume the results so any worker exception is raised here
+            list(executor.map(lambda task: encrypt(key, *task), tasks))
 
         for f in changes["deletions"]:
             os.remove(os.path.join(self.encrypted_path, f))
 
         # Write the new manifest
-        with open(self.vault_manifest_path, "w") as f:
-            json.dump(self._next_manifest(), f, indent=2)
+        write_json(self.vault_manifest_path, next_manifest)
 
-    def decrypt(self, secret_key: str) -> None:
+    def decrypt(
+        self,
+        secret_key: str,
+        rehash: bool = False,
+        changes: Optional[VaultChangeSet] = None,
+    ) -> None:
         """
         Decrypts all the encrypted files in the data vault.
+
+        Decrypted files that still match the manifest would decrypt to the
+        same contents, so they are left in place; everything else is
+        replaced. Pass the `changes` from `changes()` to reuse them instead
+        of hashing again.
         """
+        # Decode the key before touching any files so a bad key fails early
+        key = VaultKey.from_secret(secret_key)
         self._create_gitignore()  # Just in case
         self._verify_or_explode()
 
-        # Delete all decrypted files
-        for f in self.files():
+        if changes is None:
+            changes = self.changes(rehash)
+        unchanged = set(changes["unchanged"])
+        decrypt_file = decrypt_v1 if self.is_legacy() else decrypt
+
+        # The manifest lists every encrypted file, as checked above
+        encrypted = list(self.manifest_files())
+
+        # Delete the decrypted files that aren't in the vault. The others
+        # are replaced atomically, which keeps their mode.
+        for f in set(self.files()) - set(encrypted):
             os.remove(os.path.join(self.root_path, f))
 
-        for f in self.encrypted_files():
-            decrypt(secret_key, self.encrypted_path / f, self.root_path / f)
+        tasks = [
+            (self.encrypted_path / f, self.root_path / f)
+            for f in encrypted
+            if f not in unchanged
+        ]
+        with thread_pool() as executor:
+            list(executor.map(lambda task: decrypt_file(key, *task), tasks))
+
+        # The decrypted files match the manifest, so record their hashes
+        # to skip hashing them on the next change check
+        stats = {}
+        for f, file_hash in self.manifest_files().items():
+            st = os.stat(self.root_path / f)
+            stats[f] = [st.st_mtime_ns, st.st_size, file_hash]
+        self._write_stat_cache(self.version(), stats)
+
+    def version(self) -> int:
+        """
+        Returns the version of the persisted vault manifest.
+        """
+        return self.manifest()["version"]
+
+    def is_legacy(self) -> bool:
+        """
+        Returns True if the vault was written by an older version of DataVault
+        and will be upgraded the next time it is encrypted.
+        """
+        return self.version() < DataVault.VERSION
 
     def verify(self) -> bool:
         """
@@ -226,7 +586,14 @@ class DataVault:
         # directory
         for f in os.listdir(self.root_path):
             # Skip the encrypted directory
-            if f in (DataVault.ENCRYPTED_NAMESPACE, ".gitignore"):
+            if f in (
+                DataVault.ENCRYPTED_NAMESPACE,
+                ".gitignore",
+                DataVault.STAT_CACHE_FILENAME,
+            ):
+                continue
+            # Skip temporary files left behind by an interrupted write
+            elif f.startswith(TMP_PREFIX):
                 continue
             # Walk all other directories
             elif os.path.isdir(os.path.join(self.root_path, f)):
@@ -241,20 +608,9 @@ class DataVault:
             else:
                 files.append(f)
 
-        # Collect gitignore files
-        ignore_files = []
-        if (Path.home() / ".gitignore").exists():
-            with open(Path.home() / ".gitignore", "r") as f:
-                ignore_files.append(f.read())
-
-        if (Path.cwd() / ".gitignore").exists():
-            with open(Path.cwd() / ".gitignore", "r") as f:
-                ignore_files.append(f.read())
-
-        # Filter out ignored files
-        return [
-            n for n in files if not any(fnmatch(n, ignore) for ignore in ignore_files)
-        ]
+        # The repo's own gitignore rules don't apply to vault contents: data
+        # is often ignored there precisely because it belongs in the vault
+        return files
 
     def encrypted_files(self):
         """
@@ -264,11 +620,11 @@ class DataVault:
 
         for dp, dn, filenames in os.walk(self.encrypted_path):
             for f in filenames:
-                if f != DataVault.MANIFEST_FILENAME:
-                    if os.path.splitext(f)[1]:
-                        files.append(
-                            f"{Path(os.path.join(dp, f)).relative_to(self.encrypted_path)}"
-                        )
+                # Files without an extension, like README, are vault files too
+                if f != DataVault.MANIFEST_FILENAME and not f.startswith(TMP_PREFIX):
+                    files.append(
+                        f"{Path(os.path.join(dp, f)).relative_to(self.encrypted_path)}"
+                    )
         return files
 
     def is_empty(self) -> bool:
@@ -277,48 +633,39 @@ class DataVault:
         """
         return len(self.files()) == 0
 
-    def changes(self) -> VaultChangeSet:
+    def changes(
+        self, rehash: bool = False, next_manifest: Optional[VaultManifest] = None
+    ) -> VaultChangeSet:
         """
         Returns a list of the changes to the vault since the last encryption.
-        """
 
-        updates, additions, deletions = (
-            self.updates(),
-            self.additions(),
-            self.deletions(),
-        )
-        return {
-            "total": len(updates) + len(additions) + len(deletions),
-            "additions": additions,
-            "deletions": deletions,
-            "updates": updates,
-            "unchanged": [
-                f for f in self.files() if f not in set(updates + additions + deletions)
-            ],
-        }
+        Pass a `next_manifest` from `next_manifest()` to reuse its hashes.
+        """
+        if next_manifest is None:
+            next_manifest = self._next_manifest(rehash)
+        return self._changes(next_manifest)
 
-    def has_changes(self):
+    def has_changes(self, rehash: bool = False):
         """
         Returns True if there are changes to the data in the vault.
         """
-        return self.changes()["total"] > 0
+        return self.changes(rehash)["total"] > 0
 
     def additions(self) -> List[str]:
         """
         Returns a list of files that are in the decrypted directory but not
         in the vault manifest.
         """
-        manifest_files = set(self.manifest()["files"])
-        return [f for f in self.files() if f not in manifest_files]
+        return DataVault._additions(self.files(), self.manifest_filenames())
 
     def deletions(self) -> List[str]:
         """
         Returns a list of files that are in the vault manifest but not in
         the decrypted directory.
         """
-        return [f for f in self.manifest()["files"] if f not in self.files()]
+        return DataVault._deletions(self.files(), self.manifest_files())
 
-    def updates(self) -> List[str]:
+    def updates(self, rehash: bool = False) -> List[str]:
         """
         Returns a list of files that have changed since the last encryption.
 
@@ -327,26 +674,45 @@ class DataVault:
         is different than the hash of the file in the vault manifest, we
         consider the file to have changed.
         """
-        current_manifest = self.manifest()["files"]
-        next_manifest = self._next_manifest()["files"]
-
-        updates = []
-
-        for file, hash in current_manifest.items():
-            if not next_manifest.get(file):
-                continue
-            if hash == next_manifest[file]:
-                continue
-            updates.append(file)
+        return DataVault._updates(
+            self.manifest_files(), self._next_manifest(rehash)["files"]
+        )
 
-        return updates
+    def next_manifest(self, rehash: bool = False) -> VaultManifest:
+        """
+        Hashes the decrypted files and returns the manifest the next
+        encryption would persist. Pass it to `changes()` and `encrypt()` to
+        hash the vault only once.
+        """
+        return self._next_manifest(rehash)
 
     def manifest(self) -> VaultManifest:
         """
         Reads the currently persisted vault manifest file.
+
+        The parsed manifest is cached until the file changes on disk, so
+        repeated reads only cost a stat. Treat the result as read-only.
+        """
+        st = os.stat(self.vault_manifest_path)
+        signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if self._manifest_cache is None or self._manifest_cache[0] != signature:
+            manifest = read_json(self.vault_manifest_path)
+            filenames = frozenset(manifest.get("files") or ())
+            self._manifest_cache = (signature, manifest, filenames)
+        return self._manifest_cache[1]
+
+    def manifest_files(self) -> Dict[str, str]:
+        """
+        Returns the file hashes in the persisted vault manifest.
         """
-        with open(self.vault_manifest_path, "r") as f:
-            return json.load(f)
+        return self.manifest()["files"]
+
+    def manifest_filenames(self) -> FrozenSet[str]:
+        """
+        Returns the names of the files in the persisted vault manifest.
+        """
+        self.manifest()
+        return self._manifest_cache[2]
 
     def no_encypted_files(self) -> bool:
         """
@@ -384,10 +750,19 @@ class DataVault:
             raise FileNotFoundError(
                 f"Vault encrypted directory does not exist at given path: {self.encrypted_path}"
             )
-        if not DataVault._verify_manifest(self.vault_manifest_path):
+        try:
+            valid = DataVault._valid_manifest(self.manifest())
+        except Exception:
+            valid = False
+        if not valid:
             raise FileNotFoundError(
                 f"Vault manifest is invalid at given path: {self.vault_manifest_path}"
             )
+        if self.version() not in DataVault.SUPPORTED_VERSIONS:
+            raise ValueError(
+                f"Vault manifest v{self.version()} is not supported by DataVault "
+                f"v{__version__}, please upgrade DataVault: {self.vault_manifest_path}"
+            )
 
         if not (self.root_path / ".gitignore").exists():
             raise FileNotFoundError(
@@ -395,10 +770,15 @@ class DataVault:
             )
 
         # All files in the manifest must be encrypted
-        missing_files = []
-        for f in self.manifest()["files"]:
-            if not os.path.exists(os.path.join(self.encrypted_path, f)):
-                missing_files.append(f)
+        # List the encrypted directory once and only stat the names that
+        # aren't top-level entries, such as files in subdirectories
+        encrypted = set(os.listdir(self.encrypted_path))
+        missing_files = [
+            f
+            for f in self.manifest_files()
+            if f not in encrypted
+            and not os.path.exists(os.path.join(self.encrypted_path, f))
+        ]
 
         if len(missing_files) > 0:
             raise FileNotFoundError(
@@ -428,6 +808,63 @@ class DataVault:
     # Private helpers
     #
 
+    def _changes(self, next_manifest: VaultManifest) -> VaultChangeSet:
+        """
+        Returns the changes between the persisted manifest and the given next
+        manifest, so callers that already hashed the vault don't do it twice.
+        """
+        next_files = next_manifest["files"]
+        files = list(next_files)
+        current_manifest = self.manifest_files()
+        current_filenames = self.manifest_filenames()
+
+        updates, additions, deletions = (
+            DataVault._updates(current_manifest, next_files),
+            DataVault._additions(files, current_filenames),
+            DataVault._deletions(files, current_manifest),
+        )
+        changed = set(updates) | set(additions) | set(deletions)
+        return {
+            "total": len(updates) + len(additions) + len(deletions),
+            "additions": additions,
+            "deletions": deletions,
+            "updates": updates,
+            "unchanged": [f for f in files if f not in changed],
+        }
+
+    @staticmethod
+    def _additions(files: List[str], manifest_filenames: FrozenSet[str]) -> List[str]:
+        """
+        Returns the files that are not in the manifest.
+        """
+        return [f for f in files if f not in manifest_filenames]
+
+    @staticmethod
+    def _deletions(files: List[str], current_manifest: Dict[str, str]) -> List[str]:
+        """
+        Returns the manifest entries that are not in the given files.
+        """
+        present = set(files)
+        return [f for f in current_manifest if f not in present]
+
+    @staticmethod
+    def _updates(
+        current_manifest: Dict[str, str], next_manifest: Dict[str, str]
+    ) -> List[str]:
+        """
+        Returns the files whose hash differs between the two manifests.
+        """
+        updates = []
+
+        for file, hash in current_manifest.items():
+            if not next_manifest.get(file):
+                continue
+            if hash == next_manifest[file]:
+                continue
+            updates.append(file)
+
+        return updates
+
     def _create_gitignore(self):
         """
         Creates a .gitignore file in the vault root directory.
@@ -440,9 +877,7 @@ class DataVault:
         """
         Generate an empty vault manifest
         """
-        #
-        with open(self.vault_manifest_path, "w") as f:
-            json.dump(self._empty_vault_manifest(), f, indent=2)
+        write_json(self.vault_manifest_path, self._empty_vault_manifest())
 
     def _empty_vault_manifest(self) -> VaultManifest:
         """
@@ -454,13 +889,73 @@ class DataVault:
             "files": {},
         }
 
-    def _next_manifest(self) -> VaultManifest:
+    def _next_manifest(
+        self, rehash: bool = False, version: Optional[int] = None
+    ) -> VaultManifest:
         """
         Returns the next version of the vault manifest that should be persisted
         after the next encryption.
-        """
+
+        Files whose modification time and size match the stat cache reuse
+        their cached hash instead of being read again. The stat cache is
+        refreshed whenever anything had to be hashed.
+
+        :param rehash: Hash every file even if its stat is unchanged
+        :param version: The manifest version to hash the files for, which
+            defaults to the version of the persisted manifest so the hashes
+            can be compared
+        """
+        version = version or self.version()
+        # Version 1 manifests record MD5 hashes
+        hash_file = md5_hash_for_file if version == 1 else hash_for_file
+        cache = {} if rehash else self._read_stat_cache(version)
+
+        files = self.files()
+        stats = {}
+        for f in files:
+            st = os.stat(self.root_path / f)
+            stats[f] = [st.st_mtime_ns, st.st_size]
+
+        hashes = {f: cache[f][2] for f in files if cache.get(f, [])[:2] == stats[f]}
+        stale = [f for f in files if f not in hashes]
+        with thread_pool() as executor:
+            hashes.update(
+                zip(
+                    stale,
+                    executor.map(hash_file, [self.root_path / f for f in stale]),
+                )
+            )
+
+        if stale or len(cache) != len(files):
+            self._write_stat_cache(version, {f: stats[f] + [hashes[f]] for f in files})
+
         return {
             "_": "DO NOT EDIT THIS FILE. IT IS AUTOMATICALLY GENERATED.",
-            "version": self.VERSION,
-            "files": {f: md5_hash_for_file(self.root_path / f) for f in self.files()},
+            "version": version,
+            "files": {f: hashes[f] for f in files},
         }
+
+    def _read_stat_cache(self, version: int) -> Dict[str, list]:
+        """
+        Returns the [mtime_ns, size, hash] of each file recorded in the stat
+        cache, or nothing if the cache is missing or holds hashes for another
+        manifest version.
+        """
+        try:
+            cache = read_json(self.stat_cache_path)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(cache, dict) or cache.get("version") != version:
+            return {}
+        return cache.get("files") or {}
+
+    def _write_stat_cache(self, version: int, stats: Dict[str, list]) -> None:
+        """
+        Replaces the stat cache with the given [mtime_ns, size, hash] of each
+        file. The cache is only an optimization, so failing to write it is
+        not an error.
+        """
+        try:
+            write_json(self.stat_cache_path, {"version": version, "files": stats})
+        except OSError:
+            pass
@@ -6,7 +6,7 @@ import click
 import colorama
 from colorama import Fore
 
-from dihi_datavault import DataVault, __version__
+from dihi_datavault import DataVault, VaultChangeSet, __version__
 
 colorama.init()
 
@@ -57,15 +57,27 @@ def find_vault(vault_path: str) -> DataVault:
             f"Found {len(vaults)} vaults. Please specify the one you want to inspect."
         )
         exit(1)
-    return vaults[0]
+
+    vault = vaults[0]
+    if vault.version() not in DataVault.SUPPORTED_VERSIONS:
+        click.echo(
+            f"The vault at '{vault.root_path}' uses manifest v{vault.version()}, "
+            f"which DataVault v{__version__} can't read. Please upgrade DataVault."
+        )
+        exit(1)
+    if vault.is_legacy():
+        click.echo(
+            f"{Fore.YELLOW}The vault at '{vault.root_path}' uses the old manifest "
+            f"v{vault.version()}. Decrypt it and encrypt it again to upgrade it to "
+            f"v{DataVault.VERSION}.{Fore.RESET}"
+        )
+    return vault
 
 
-def show_changes(vault: DataVault):
+def show_changes(changes: VaultChangeSet):
     """
     Shows all the changes to the files in the vault.
     """
-    changes = vault.changes()
-
     click.echo("The following changes have occurred since the last encryption:")
 
     for file in changes["additions"]:
@@ -154,18 +166,30 @@ def new(vault_path):
     is_flag=True,
     help="Confirm before encrypting.",
 )
-def encrypt(vault_path, interactive):
+@click.option(
+    "--rehash",
+    default=False,
+    is_flag=True,
+    help="Hash every file instead of skipping ones with unchanged timestamps.",
+)
+def encrypt(vault_path, interactive, rehash):
     vault = find_vault(vault_path)
 
     click.echo(f"Encrypting vault at '{vault.root_path}'")
+    # Hash the vault once to both show the changes and encrypt them
+    next_manifest = vault.next_manifest(rehash)
+    changes = vault.changes(next_manifest=next_manifest)
     if vault.is_empty():
         click.echo("Vault is empty. Nothing to encrypt.")
-    elif vault.has_changes():
-        show_changes(vault)
+    elif changes["total"] > 0 or vault.is_legacy():
+        # Older vaults are re-encrypted in full to upgrade them
+        if vault.is_legacy():
+            click.echo(f"Upgrading the vault to manifest v{DataVault.VERSION}.")
+        show_changes(changes)
         if not interactive or confirm(
             "Are you sure you want to encrypt these changes?"
         ):
-            vault.encrypt(fetch_secret())
+            vault.encrypt(fetch_secret(), next_manifest=next_manifest)
             click.echo(f"{vault.root_path} encrypted.")
         else:
             print("Encryption cancelled.")
@@ -192,7 +216,13 @@ def encrypt(vault_path, interactive):
     is_flag=True,
     help="Force decrypting and overwrite if there are changes.",
 )
-def decrypt(vault_path, interactive, force):
+@click.option(
+    "--rehash",
+    default=False,
+    is_flag=True,
+    help="Hash every file instead of skipping ones with unchanged timestamps.",
+)
+def decrypt(vault_path, interactive, force, rehash):
     if interactive and force:
         click.echo(
             "You can't force decrypt and interactively decrypt at the same time."
@@ -205,41 +235,51 @@ def decrypt(vault_path, interactive, force):
     if vault.no_encypted_files():
         click.echo("Vault is empty. Nothing to decrypt.")
     elif force:
-        vault.decrypt(fetch_secret())
+        # Overwrite every local edit, even ones that kept the file's timestamp
+        vault.decrypt(fetch_secret(), rehash=True)
         click.echo(f"{vault.root_path} decrypted.")
-    elif vault.has_changes():
-        click.echo("This vault has changes.")
-        show_changes(vault)
-
-        if interactive and confirm(
-            f"{Fore.YELLOW}Are you sure you want to replace the changes with newly decrypted files?{Fore.RESET}"
-        ):
-            vault.decrypt(fetch_secret())
-            click.echo(f"{vault.root_path} decrypted.")
-        else:
-            click.echo(
-                "Due to the changes, you must use -f to force decrypt or -i to decrypt interactively."
-            )
     else:
-        # Vault has no changes, so just decrypt it.
-        vault.decrypt(fetch_secret())
-        click.echo(f"{vault.root_path} decrypted.")
+        changes = vault.changes(rehash)
+        if changes["total"] > 0:
+            click.echo("This vault has changes.")
+            show_changes(changes)
+
+            if interactive and confirm(
+                f"{Fore.YELLOW}Are you sure you want to replace the changes with newly decrypted files?{Fore.RESET}"
+            ):
+                vault.decrypt(fetch_secret(), changes=changes)
+                click.echo(f"{vault.root_path} decrypted.")
+            else:
+                click.echo(
+                    "Due to the changes, you must use -f to force decrypt or -i to decrypt interactively."
+                )
+        else:
+            # Vault has no changes, so just decrypt it.
+            vault.decrypt(fetch_secret(), changes=changes)
+            click.echo(f"{vault.root_path} decrypted.")
 
 
 # Inspect Command
 #
 @main.command(help="Show the changes across all vaults in the search path.")
 @click.argument("vault_path", default=os.getcwd())
-def inspect(vault_path):
+@click.option(
+    "--rehash",
+    default=False,
+    is_flag=True,
+    help="Hash every file instead of skipping ones with unchanged timestamps.",
+)
+def inspect(vault_path, rehash):
     vault = find_vault(vault_path)
 
     click.echo(f"Vault located at '{vault.root_path}'")
+    changes = vault.changes(rehash)
     if vault.is_empty():
         click.echo("Vault is empty. Nothing to inspect.")
-    elif not vault.has_changes():
+    elif changes["total"] == 0:
         click.echo("Vault has no changes. Nothing to inspect.")
     else:
-        show_changes(vault)
+        show_changes(changes)
     click.echo()
 
 
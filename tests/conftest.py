@@ -0,0 +1,56 @@
+import os
+import shutil
+import sys
+from pathlib import Path
+
+import pytest
+
+from dihi_datavault import DataVault
+
+# A vault encrypted by DataVault 0.1.0, which wrote version 1 manifests.
+# It holds data.csv ("a,b\n1,2\n") and secret.txt ("v1 secret\n").
+V1_VAULT = Path(__file__).parent / "fixtures" / "v1_vault"
+V1_SECRET = "tzfvBHKYO3sJVnhZq7zSz9syfGMBQpZbyrjAjkYw4U4="
+
+
+def pytest_configure(config):
+    # Keep pytest's temporary directories on tmpfs where it's available
+    if sys.platform == "linux" and os.path.isdir("/dev/shm"):
+        os.environ.setdefault("PYTEST_DEBUG_TEMPROOT", "/dev/shm")
+
+
+@pytest.fixture(autouse=True)
+def isolated_home_and_cwd(tmp_path, monkeypatch):
+    """
+    Runs each test from its own tmp_path, with it as the home directory too,
+    so the developer's files such as ~/.gitignore can't affect the results.
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.setenv("USERPROFILE", str(tmp_path))
+
+
+@pytest.fixture(scope="session")
+def datavault_secret():
+    return DataVault.generate_secret()
+
+
+@pytest.fixture
+def stub_secret(monkeypatch, datavault_secret):
+    monkeypatch.setattr(DataVault, "generate_secret", lambda: datavault_secret)
+    return datavault_secret
+
+
+@pytest.fixture
+def v1_secret():
+    return V1_SECRET
+
+
+@pytest.fixture
+def v1_vault(tmp_path):
+    """
+    Returns a copy of the version 1 fixture vault with nothing decrypted.
+    """
+    path = tmp_path / "v1_vault"
+    shutil.copytree(V1_VAULT, path)
+    return DataVault(path)
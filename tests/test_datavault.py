@@ -1,24 +1,28 @@
-import tempfile
+import json
+import os
+import shutil
+import stat
+from hashlib import blake2b
 from pathlib import Path
 
 import pytest
+from cryptography.fernet import InvalidToken
 
-from dihi_datavault import DataVault
-
-DATAVAULT_SECRET = DataVault.generate_secret()
-
-
-@pytest.fixture
-def stub_secret(monkeypatch):
-    def secret():
-        return DATAVAULT_SECRET
-
-    monkeypatch.setattr(DataVault, "generate_secret", secret)
+import dihi_datavault
+from dihi_datavault import (
+    DataVault,
+    VaultKey,
+    atomic_write,
+    decrypt,
+    encrypt,
+    hash_for_file,
+    write_json,
+)
 
 
 @pytest.fixture
-def vault():
-    path = str(Path(tempfile.mkdtemp()) / "vault")
+def vault(tmp_path: Path):
+    path = str(tmp_path / "vault")
     vault = DataVault(path)
     vault.create()
     return vault
@@ -42,7 +46,7 @@ def test_files(vault: DataVault):
     assert vault.files() == ["test.txt"]
 
 
-def test_encrypt_decrypt(vault: DataVault):
+def test_encrypt_decrypt(vault: DataVault, datavault_secret: str):
     assert vault.is_empty()
 
     with open(str(vault.root_path / "test.txt"), "w") as f:
@@ -52,8 +56,305 @@ def test_encrypt_decrypt(vault: DataVault):
     assert vault.encrypted_files() == []
     assert vault.changes()["additions"] == ["test.txt"]
 
-    vault.encrypt(DATAVAULT_SECRET)
+    vault.encrypt(datavault_secret)
 
     assert vault.files() == ["test.txt"]
     assert vault.encrypted_files() == ["test.txt"]
     assert vault.changes()["additions"] == []
+
+
+def test_encrypt_decrypt_file(tmp_path: Path, datavault_secret: str):
+    data = os.urandom(100_000)
+    (tmp_path / "plain").write_bytes(data)
+
+    encrypt(datavault_secret, tmp_path / "plain", tmp_path / "enc", block=4096)
+    assert (tmp_path / "enc").read_bytes() != data
+
+    decrypt(datavault_secret, tmp_path / "enc", tmp_path / "dec", block=4096)
+    assert (tmp_path / "dec").read_bytes() == data
+
+
+def test_decrypt_tampered_file(tmp_path: Path, datavault_secret: str):
+    (tmp_path / "plain").write_bytes(b"test")
+    encrypt(datavault_secret, tmp_path / "plain", tmp_path / "enc")
+
+    enc = bytearray((tmp_path / "enc").read_bytes())
+    enc[20] ^= 1
+    (tmp_path / "enc").write_bytes(enc)
+
+    with pytest.raises(InvalidToken):
+        decrypt(datavault_secret, tmp_path / "enc", tmp_path / "dec")
+    assert not (tmp_path / "dec").exists()
+
+    # An existing output is left alone and no plaintext is left behind
+    (tmp_path / "dec").write_bytes(b"keep")
+    with pytest.raises(InvalidToken):
+        decrypt(datavault_secret, tmp_path / "enc", tmp_path / "dec")
+    assert (tmp_path / "dec").read_bytes() == b"keep"
+    assert sorted(os.listdir(tmp_path)) == ["dec", "enc", "plain"]
+
+    with pytest.raises(InvalidToken):
+        decrypt(DataVault.generate_secret(), tmp_path / "plain", tmp_path / "dec")
+
+
+def test_files_ignore_repo_gitignore(
+    v1_vault: DataVault, tmp_path: Path, monkeypatch, v1_secret: str
+):
+    # Data repos often gitignore the very files they keep in a vault
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / ".gitignore").write_text("*.csv\n")
+    monkeypatch.setenv("HOME", str(tmp_path))
+
+    vault = DataVault(v1_vault.root_path)
+    vault.decrypt(v1_secret)
+    assert sorted(vault.files()) == ["data.csv", "secret.txt"]
+
+    (vault.root_path / "secret.txt").write_text("edited")
+    assert vault.changes()["deletions"] == []
+    vault.encrypt(v1_secret)
+
+    assert "data.csv" in vault.manifest_files()
+    assert (vault.encrypted_path / "data.csv").exists()
+
+
+def test_changes_skip_unchanged_stat(vault: DataVault, datavault_secret: str):
+    path = vault.root_path / "test.txt"
+    path.write_text("test")
+    vault.encrypt(datavault_secret)
+
+    # Rewrite the file without changing its size or modification time
+    st = os.stat(path)
+    path.write_text("best")
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    assert vault.changes()["updates"] == []
+    assert vault.changes(rehash=True)["updates"] == ["test.txt"]
+
+    path.write_text("test updated")
+    assert vault.changes()["updates"] == ["test.txt"]
+
+
+def test_stat_cache_is_local(
+    vault: DataVault, tmp_path: Path, monkeypatch, datavault_secret: str
+):
+    (vault.root_path / "test.txt").write_text("test")
+    vault.encrypt(datavault_secret)
+    assert "stat" not in vault.manifest()
+    assert vault.files() == ["test.txt"]
+
+    # A fresh clone only has the encrypted directory
+    clone = DataVault(tmp_path / "clone")
+    clone.root_path.mkdir()
+    shutil.copytree(vault.encrypted_path, clone.encrypted_path)
+    clone.decrypt(datavault_secret)
+
+    hashed = []
+    monkeypatch.setattr(
+        dihi_datavault, "hash_for_file", lambda path: hashed.append(path) or ""
+    )
+    assert clone.changes()["total"] == 0
+    assert hashed == []
+
+
+def test_find_all(tmp_path: Path):
+    vaults = [DataVault(tmp_path / "a"), DataVault(tmp_path / "b" / "c")]
+    (tmp_path / "b").mkdir()
+    for vault in vaults:
+        vault.create()
+
+    # Vaults inside skipped directories aren't searched
+    (tmp_path / "node_modules").mkdir()
+    DataVault(tmp_path / "node_modules" / "d").create()
+
+    assert [v.root_path for v in DataVault.find_all(tmp_path)] == [
+        v.root_path for v in vaults
+    ]
+
+
+def test_write_json_without_orjson(tmp_path: Path, monkeypatch):
+    pytest.importorskip("orjson")
+    data = {"version": 2, "files": {"b.txt": "1", "é.txt": "2"}}
+
+    write_json(tmp_path / "orjson.json", data)
+    monkeypatch.setattr(dihi_datavault, "orjson", None)
+    write_json(tmp_path / "json.json", data)
+
+    assert (tmp_path / "orjson.json").read_bytes() == (
+        tmp_path / "json.json"
+    ).read_bytes()
+
+
+def test_hash_for_file(tmp_path: Path):
+    (tmp_path / "empty").write_bytes(b"")
+    (tmp_path / "data").write_bytes(b"test")
+
+    assert hash_for_file(tmp_path / "empty") == blake2b(digest_size=32).hexdigest()
+    assert (
+        hash_for_file(tmp_path / "data") == blake2b(b"test", digest_size=32).hexdigest()
+    )
+
+
+def test_decrypt_keeps_unchanged_files(vault: DataVault, datavault_secret: str):
+    (vault.root_path / "same.txt").write_text("same")
+    (vault.root_path / "edited.txt").write_text("edited")
+    vault.encrypt(datavault_secret)
+
+    same_inode = os.stat(vault.root_path / "same.txt").st_ino
+    (vault.root_path / "edited.txt").write_text("local edit")
+    (vault.root_path / "added.txt").write_text("added")
+
+    vault.decrypt(datavault_secret)
+
+    assert os.stat(vault.root_path / "same.txt").st_ino == same_inode
+    assert (vault.root_path / "edited.txt").read_text() == "edited"
+    assert not (vault.root_path / "added.txt").exists()
+    # No temporary files are left behind by the encryption
+    assert sorted(os.listdir(vault.encrypted_path)) == [
+        "edited.txt",
+        "same.txt",
+        DataVault.MANIFEST_FILENAME,
+    ]
+
+
+def test_atomic_write(tmp_path: Path):
+    path = tmp_path / "data.json"
+    write_json(path, {"version": 1})
+
+    with pytest.raises(RuntimeError):
+        with atomic_write(path) as f:
+            f.write(b"{")
+            raise RuntimeError("interrupted")
+
+    assert os.listdir(tmp_path) == ["data.json"]
+    assert json.loads(path.read_text()) == {"version": 1}
+
+
+def test_extensionless_files(vault: DataVault, datavault_secret: str):
+    (vault.root_path / "README").write_text("readme")
+    (vault.root_path / "data.txt").write_text("data")
+    vault.encrypt(datavault_secret)
+    assert sorted(vault.encrypted_files()) == ["README", "data.txt"]
+
+    vault.clear()
+    vault.decrypt(datavault_secret)
+    assert (vault.root_path / "README").read_text() == "readme"
+    assert vault.changes()["total"] == 0
+
+
+def test_atomic_write_mode(vault: DataVault, monkeypatch, datavault_secret: str):
+    monkeypatch.setattr(dihi_datavault, "UMASK", 0o022)
+
+    (vault.root_path / "data.txt").write_text("data")
+    (vault.root_path / "run.sh").write_text("run")
+    os.chmod(vault.root_path / "run.sh", 0o755)
+    vault.encrypt(datavault_secret)
+
+    mode = lambda path: stat.S_IMODE(os.stat(path).st_mode)
+    assert mode(vault.vault_manifest_path) == 0o644
+    assert mode(vault.encrypted_path / "data.txt") == 0o644
+
+    # Replaced files keep their mode and new ones follow the umask
+    (vault.root_path / "run.sh").write_text("edited")
+    os.remove(vault.root_path / "data.txt")
+    vault.decrypt(datavault_secret)
+    assert mode(vault.root_path / "run.sh") == 0o755
+    assert mode(vault.root_path / "data.txt") == 0o644
+
+
+def test_atomic_write_keeps_tmp_named_files(vault: DataVault, datavault_secret: str):
+    (vault.root_path / "x.txt.tmp").write_text("tmp")
+    vault.encrypt(datavault_secret)
+    (vault.root_path / "x.txt").write_text("x")
+    vault.encrypt(datavault_secret)
+
+    assert vault.verify()
+    assert sorted(os.listdir(vault.encrypted_path)) == [
+        DataVault.MANIFEST_FILENAME,
+        "x.txt",
+        "x.txt.tmp",
+    ]
+
+    # A temporary file left behind by an interrupted run is ignored
+    (vault.encrypted_path / f"{dihi_datavault.TMP_PREFIX}abc.txt").write_text("")
+    (vault.root_path / f"{dihi_datavault.TMP_PREFIX}abc.txt").write_text("")
+    assert sorted(vault.encrypted_files()) == ["x.txt", "x.txt.tmp"]
+
+    vault.clear()
+    vault.decrypt(datavault_secret)
+    assert (vault.root_path / "x.txt.tmp").read_text() == "tmp"
+    assert (vault.root_path / "x.txt").read_text() == "x"
+
+
+def test_manifest_cache(vault: DataVault, datavault_secret: str):
+    assert vault.manifest() is vault.manifest()
+    assert vault.manifest_filenames() == frozenset()
+
+    # Changes written through another instance are picked up
+    (vault.root_path / "test.txt").write_text("test")
+    DataVault(vault.root_path).encrypt(datavault_secret)
+
+    assert vault.manifest_filenames() == frozenset(["test.txt"])
+    assert list(vault.manifest_files()) == ["test.txt"]
+
+
+def test_verify_missing_encrypted_file(vault: DataVault, datavault_secret: str):
+    (vault.root_path / "test.txt").write_text("test")
+    vault.encrypt(datavault_secret)
+    assert vault.verify()
+
+    os.remove(vault.encrypted_path / "test.txt")
+    assert not vault.verify()
+
+
+def test_vault_key(vault: DataVault, tmp_path: Path, datavault_secret: str):
+    key = VaultKey.from_secret(datavault_secret)
+    assert VaultKey.from_secret(key) is key
+
+    (tmp_path / "plain").write_bytes(b"test")
+    encrypt(key, tmp_path / "plain", tmp_path / "enc")
+    decrypt(datavault_secret, tmp_path / "enc", tmp_path / "dec")
+    assert (tmp_path / "dec").read_bytes() == b"test"
+
+    # A malformed secret is rejected before any decrypted files are removed
+    (vault.root_path / "test.txt").write_text("test")
+    vault.encrypt(datavault_secret)
+    (vault.root_path / "test.txt").write_text("local edit")
+    with pytest.raises(ValueError):
+        vault.decrypt("bad")
+    assert (vault.root_path / "test.txt").read_text() == "local edit"
+
+
+def test_upgrade_v1_vault(v1_vault: DataVault, v1_secret: str):
+    assert [v.root_path for v in DataVault.find_all(v1_vault.root_path)] == [
+        v1_vault.root_path
+    ]
+    assert v1_vault.is_legacy()
+
+    v1_vault.decrypt(v1_secret)
+    assert (v1_vault.root_path / "data.csv").read_text() == "a,b\n1,2\n"
+    assert (v1_vault.root_path / "secret.txt").read_text() == "v1 secret\n"
+    # The version 1 hashes still match the decrypted files
+    assert v1_vault.changes(rehash=True)["total"] == 0
+
+    # Encrypting upgrades every file and the manifest to the current version
+    v1_vault.encrypt(v1_secret)
+    assert v1_vault.version() == DataVault.VERSION
+    assert v1_vault.manifest_files() == {
+        f: hash_for_file(v1_vault.root_path / f) for f in ["data.csv", "secret.txt"]
+    }
+    v1_vault.clear()
+    v1_vault.decrypt(v1_secret)
+    assert (v1_vault.root_path / "secret.txt").read_text() == "v1 secret\n"
+
+
+def test_unsupported_version(vault: DataVault):
+    manifest = vault.manifest()
+    write_json(vault.vault_manifest_path, {**manifest, "version": 99})
+
+    # The vault is still found so the CLI can explain why it can't be used
+    assert [v.root_path for v in DataVault.find_all(vault.root_path)] == [
+        vault.root_path
+    ]
+    assert not vault.verify()
+    with pytest.raises(ValueError, match="v99 is not supported"):
+        vault.encrypt(DataVault.generate_secret())
@@ -1,22 +1,64 @@
+import json
+import shutil
 import subprocess
 import os
-import tempfile
 from pathlib import Path
 
 import pytest
 from click.testing import CliRunner
 
+import dihi_datavault
 from dihi_datavault import DataVault, __version__, cli
 
-DATAVAULT_SECRET = DataVault.generate_secret()
+
+def snapshot(path) -> set:
+    """
+    Returns the names in a directory from a single scandir call.
+    """
+    with os.scandir(path) as it:
+        return {entry.name for entry in it}
+
+
+def load_manifest(vault: DataVault) -> dict:
+    """
+    Returns the parsed manifest of a vault.
+    """
+    return json.loads(Path(vault.vault_manifest_path).read_text())
+
+
+@pytest.fixture(scope="module")
+def fresh_vault(tmp_path_factory):
+    """
+    Creates one vault with the CLI and returns a factory that copies it to
+    a new path, so tests don't each pay for creating a vault.
+    """
+    template = tmp_path_factory.mktemp("vault_template") / "vault"
+    result = CliRunner().invoke(cli.main, ["new", str(template)])
+    assert result.exit_code == 0
+
+    def make(path: Path) -> DataVault:
+        shutil.copytree(template, path)
+        return DataVault(path)
+
+    return make
 
 
 @pytest.fixture
-def stub_secret(monkeypatch):
-    def secret():
-        return DATAVAULT_SECRET
+def fast_crypto(monkeypatch):
+    """
+    Swaps the file ciphers for a reversible null cipher in tests that only
+    check the CLI wiring and manifest handling. The real ciphers are tested
+    in test_datavault.py.
+    """
+
+    def encrypt(key, fin, fout):
+        Path(fout).write_bytes(b"ENC" + Path(fin).read_bytes())
+
+    def decrypt(key, fin, fout):
+        Path(fout).write_bytes(Path(fin).read_bytes()[3:])
 
-    monkeypatch.setattr(DataVault, "generate_secret", secret)
+    monkeypatch.setattr(dihi_datavault, "encrypt", encrypt)
+    monkeypatch.setattr(dihi_datavault, "decrypt", decrypt)
 
 
 def test_cli_version():
@@ -26,15 +68,15 @@ def test_cli_version():
     assert result.output.find(__version__) > 0
 
 
-def test_cli_new(stub_secret):
+def test_cli_new(stub_secret, tmp_path):
     path = "vault"
     runner = CliRunner()
-    with runner.isolated_filesystem() as tempdir:
+    with runner.isolated_filesystem(temp_dir=tmp_path) as tempdir:
         result = runner.invoke(cli.main, ["new", path])
         # The command shoul hae succeeded
         assert result.exit_code == 0
         # The secret should have been out output
-        assert result.output.find(DATAVAULT_SECRET) > 0
+        assert result.output.find(stub_secret) > 0
 
         vault = DataVault(Path(tempdir) / "vault")
         assert vault.verify()
@@ -46,32 +88,31 @@ def test_cli_new(stub_secret):
         assert result.exit_code == 1
 
 
-def test_gitignore(stub_secret):
+def test_gitignore(stub_secret, tmp_path):
     path = "vault"
     runner = CliRunner()
-    with runner.isolated_filesystem() as tempdir:
+    with runner.isolated_filesystem(temp_dir=tmp_path) as tempdir:
         result = runner.invoke(cli.main, ["new", path])
 
         assert result.exit_code == 0
 
         vault = DataVault(Path(tempdir) / path)
 
-        result = subprocess.run(["cat", "vault/.gitignore"], capture_output=True)
-        assert result.returncode == 0
-
-        gitignore_contents = result.stdout.decode("utf-8")
+        gitignore_contents = (vault.root_path / ".gitignore").read_text()
+        assert gitignore_contents == f"/*\n!/{DataVault.ENCRYPTED_NAMESPACE}\n"
 
         # Write some data to the vault
         with open(Path(vault.root_path) / "test1.txt", "w") as f:
             f.write("test1")
         with open(Path(vault.root_path) / "test2.txt", "w") as f:
             f.write("test2")
-        result = subprocess.run(["git", "init"], cwd=tempdir)
-        assert result.returncode == 0
-        result = subprocess.run(["git", "add", "."], cwd=tempdir, capture_output=True)
-        assert result.returncode == 0
-        result = subprocess.run(["git", "status"], cwd=tempdir, capture_output=True)
-        assert result.returncode == 0
+        result = subprocess.run(
+            "git init -q && git add -A && git status --porcelain",
+            shell=True,
+            cwd=tempdir,
+            capture_output=True,
+            check=True,
+        )
         message = result.stdout.decode("utf-8")
 
         # test1.txt and test2.txt should not be in the git status output
@@ -84,226 +125,305 @@ def test_cli_secret(stub_secret):
     runner = CliRunner()
     result = runner.invoke(cli.main, ["secret"])
     assert result.exit_code == 0
-    assert result.output.find(DATAVAULT_SECRET) > 0
+    assert result.output.find(stub_secret) > 0
 
 
-def test_cli_encrypt_decrypt():
+def test_cli_encrypt_decrypt(fresh_vault, fast_crypto, tmp_path, datavault_secret):
     """
     This is a throughout test of CLI and DataVault API.
     """
-    path = "test_vault"
     runner = CliRunner()
 
-    with runner.isolated_filesystem():
-        #
-        # Create a new vault
-        #
-        result = runner.invoke(cli.main, ["new", path])
-        assert result.exit_code == 0
-
-        vault = DataVault(path)
-        assert vault.verify()
-        assert vault.is_empty()
+    #
+    # Create a new vault
+    #
+    vault = fresh_vault(tmp_path / "test_vault")
+    path = str(vault.root_path)
+    assert vault.verify()
+    assert vault.is_empty()
 
-        assert len(os.listdir(vault.encrypted_path)) == 1
-        assert DataVault.MANIFEST_FILENAME in os.listdir(vault.encrypted_path)
+    assert snapshot(vault.encrypted_path) == {DataVault.MANIFEST_FILENAME}
 
-        #
-        # Add some files to the vault
-        #
+    #
+    # Add some files to the vault
+    #
 
-        with open(Path(vault.root_path) / "test1.txt", "w") as f:
-            f.write("test1")
+    with open(Path(vault.root_path) / "test1.txt", "w") as f:
+        f.write("test1")
 
-        with open(Path(vault.root_path) / "test2.txt", "w") as f:
-            f.write("test2")
+    with open(Path(vault.root_path) / "test2.txt", "w") as f:
+        f.write("test2")
 
-        assert vault.has_changes()
-        changes = vault.changes()
-        assert vault.verify()
-        assert changes["total"] == 2
-        assert list(sorted(changes["additions"])) == ["test1.txt", "test2.txt"]
-        assert changes["deletions"] == []
-        assert changes["updates"] == []
+    assert vault.has_changes()
+    changes = vault.changes()
+    assert vault.verify()
+    assert changes["total"] == 2
+    assert list(sorted(changes["additions"])) == ["test1.txt", "test2.txt"]
+    assert changes["deletions"] == []
+    assert changes["updates"] == []
 
-        #
-        # Encrypt the vault
-        #
+    #
+    # Encrypt the vault
+    #
 
-        result = runner.invoke(
-            cli.main, ["encrypt", path], env={"DATAVAULT_SECRET": DATAVAULT_SECRET}
-        )
-        assert result.exit_code == 0
+    result = runner.invoke(
+        cli.main, ["encrypt", path], env={"DATAVAULT_SECRET": datavault_secret}
+    )
+    assert result.exit_code == 0
 
-        # Ensure the files are encrypted
-        assert os.path.exists(Path(vault.encrypted_path) / "test1.txt")
-        assert os.path.exists(Path(vault.encrypted_path) / "test2.txt")
+    # Ensure the files are encrypted
+    assert {"test1.txt", "test2.txt"} <= snapshot(vault.encrypted_path)
 
-        # Ensure the files are listed in the manifest
-        with open(vault.vault_manifest_path, "r") as f:
-            manifest = f.read()
-            assert manifest.find("test1.txt") > 0
-            assert manifest.find("test2.txt") > 0
+    # Ensure the files are listed in the manifest
+    manifest = load_manifest(vault)
+    assert "test1.txt" in manifest["files"]
+    assert "test2.txt" in manifest["files"]
 
-        # The encrypted file is not the same as the decrypted file
-        assert not os.path.samefile(
-            Path(vault.encrypted_path) / "test1.txt",
-            Path(vault.root_path) / "test1.txt",
-        )
+    # The encrypted file is not the same as the decrypted file
+    assert (
+        os.stat(Path(vault.encrypted_path) / "test1.txt").st_ino
+        != os.stat(Path(vault.root_path) / "test1.txt").st_ino
+    )
 
-        # Delete all decrypted files
-        vault.clear()
+    # Delete all decrypted files
+    vault.clear()
 
-        # The encrypted directory should be empty even though the keepfile is present
-        assert vault.is_empty()
+    # The encrypted directory should be empty even though the keepfile is present
+    assert vault.is_empty()
 
-        #
-        # Decrypt the vault
-        #
+    #
+    # Decrypt the vault
+    #
 
-        result = runner.invoke(
-            cli.main,
-            ["decrypt", "-f", path],
-            env={"DATAVAULT_SECRET": DATAVAULT_SECRET},
-        )
-        assert result.exit_code == 0
+    result = runner.invoke(
+        cli.main,
+        ["decrypt", "-f", path],
+        env={"DATAVAULT_SECRET": datavault_secret},
+    )
+    assert result.exit_code == 0
 
-        # assert the contents of the decrypted file is the same as the original
-        with open(Path(vault.root_path) / "test1.txt", "r") as f:
-            assert f.read() == "test1"
+    # assert the contents of the decrypted file is the same as the original
+    with open(Path(vault.root_path) / "test1.txt", "r") as f:
+        assert f.read() == "test1"
 
-        with open(Path(vault.root_path) / "test2.txt", "r") as f:
-            assert f.read() == "test2"
+    with open(Path(vault.root_path) / "test2.txt", "r") as f:
+        assert f.read() == "test2"
 
-        #
-        # Delete and update a file in the vault
-        #
+    #
+    # Delete and update a file in the vault
+    #
 
-        os.remove(Path(vault.root_path) / "test1.txt")
+    os.remove(Path(vault.root_path) / "test1.txt")
 
-        with open(Path(vault.root_path) / "test2.txt", "w") as f:
-            f.write("test2 updated")
+    with open(Path(vault.root_path) / "test2.txt", "w") as f:
+        f.write("test2 updated")
 
-        assert vault.has_changes()
-        changes = vault.changes()
+    assert vault.has_changes()
+    changes = vault.changes()
 
-        assert changes["total"] == 2
-        assert changes["additions"] == []
-        assert changes["deletions"] == ["test1.txt"]
-        assert changes["updates"] == ["test2.txt"]
+    assert changes["total"] == 2
+    assert changes["additions"] == []
+    assert changes["deletions"] == ["test1.txt"]
+    assert changes["updates"] == ["test2.txt"]
 
-        #
-        # Encrypt the vault again
-        #
+    #
+    # Encrypt the vault again
+    #
 
-        result = runner.invoke(
-            cli.main, ["encrypt", path], env={"DATAVAULT_SECRET": DATAVAULT_SECRET}
-        )
-        assert result.exit_code == 0
-        assert vault.verify()
+    result = runner.invoke(
+        cli.main, ["encrypt", path], env={"DATAVAULT_SECRET": datavault_secret}
+    )
+    assert result.exit_code == 0
+    assert vault.verify()
 
-        # test1.txt should be deleted from the encrypted directory
-        assert not os.path.exists(Path(vault.encrypted_path) / "test1.txt")
-        # test2.txt should be updated in the encrypted directory
-        assert os.path.exists(Path(vault.encrypted_path) / "test2.txt")
+    encrypted = snapshot(vault.encrypted_path)
+    # test1.txt should be deleted from the encrypted directory
+    assert "test1.txt" not in encrypted
+    # test2.txt should be updated in the encrypted directory
+    assert "test2.txt" in encrypted
 
-        # Ensure the files are listed in the manifest
-        with open(vault.vault_manifest_path, "r") as f:
-            manifest = f.read()
-            assert manifest.find("test1.txt") == -1
-            assert manifest.find("test2.txt") > 0
+    # Ensure the files are listed in the manifest
+    manifest = load_manifest(vault)
+    assert "test1.txt" not in manifest["files"]
+    assert "test2.txt" in manifest["files"]
 
-        # Delete all decrypted files
-        vault.clear()
+    # Delete all decrypted files
+    vault.clear()
 
-        #
-        # Decrypt the vault again and verify its contents
-        #
+    #
+    # Decrypt the vault again and verify its contents
+    #
 
-        result = runner.invoke(
-            cli.main,
-            ["decrypt", "-f", path],
-            env={"DATAVAULT_SECRET": DATAVAULT_SECRET},
-        )
-        assert result.exit_code == 0
-        assert vault.verify()
-        # test1.txt should be deleted from the decrypted directory
-        assert not os.path.exists(Path(vault.root_path) / "test1.txt")
-        # test2.txt should have the updated text
-        with open(Path(vault.root_path) / "test2.txt", "r") as f:
-            assert f.read() == "test2 updated"
+    result = runner.invoke(
+        cli.main,
+        ["decrypt", "-f", path],
+        env={"DATAVAULT_SECRET": datavault_secret},
+    )
+    assert result.exit_code == 0
+    assert vault.verify()
+    # test1.txt should be deleted from the decrypted directory
+    assert "test1.txt" not in snapshot(vault.root_path)
+    # test2.txt should have the updated text
+    with open(Path(vault.root_path) / "test2.txt", "r") as f:
+        assert f.read() == "test2 updated"
 
 
-def test_clearing():
+def test_clearing(fresh_vault, fast_crypto, tmp_path, datavault_secret):
 
     #
     # Create a new vault
     #
 
-    path = "test_clearing_vault"
     runner = CliRunner()
 
-    with runner.isolated_filesystem():
-        result = runner.invoke(cli.main, ["new", path])
-        assert result.exit_code == 0
+    vault = fresh_vault(tmp_path / "test_clearing_vault")
+    path = str(vault.root_path)
+    assert vault.verify()
+    assert vault.is_empty()
 
-        vault = DataVault(path)
-        assert vault.verify()
-        assert vault.is_empty()
+    assert snapshot(vault.encrypted_path) == {DataVault.MANIFEST_FILENAME}
 
-        assert len(os.listdir(vault.encrypted_path)) == 1
-        assert DataVault.MANIFEST_FILENAME in os.listdir(vault.encrypted_path)
+    #
+    # Add some files to the vault
+    #
 
-        #
-        # Add some files to the vault
-        #
+    with open(Path(vault.root_path) / "test1.txt", "w") as f:
+        f.write("test1")
 
-        with open(Path(vault.root_path) / "test1.txt", "w") as f:
-            f.write("test1")
+    with open(Path(vault.root_path) / "test2.txt", "w") as f:
+        f.write("test2")
 
-        with open(Path(vault.root_path) / "test2.txt", "w") as f:
-            f.write("test2")
+    assert vault.has_changes()
+    changes = vault.changes()
+    assert changes["total"] == 2
+    assert list(sorted(changes["additions"])) == ["test1.txt", "test2.txt"]
+    assert changes["deletions"] == []
+    assert changes["updates"] == []
+
+    #
+    # Encrypt the vault
+    #
 
-        assert vault.has_changes()
-        changes = vault.changes()
-        assert changes["total"] == 2
-        assert list(sorted(changes["additions"])) == ["test1.txt", "test2.txt"]
-        assert changes["deletions"] == []
-        assert changes["updates"] == []
+    result = runner.invoke(
+        cli.main, ["encrypt", path], env={"DATAVAULT_SECRET": datavault_secret}
+    )
+    assert result.exit_code == 0
 
-        #
-        # Encrypt the vault
-        #
+    # Ensure the files are encrypted
+    assert {"test1.txt", "test2.txt"} <= snapshot(vault.encrypted_path)
 
-        result = runner.invoke(
-            cli.main, ["encrypt", path], env={"DATAVAULT_SECRET": DATAVAULT_SECRET}
-        )
-        assert result.exit_code == 0
+    result = runner.invoke(
+        cli.main,
+        ["clear-decrypted", "-f", path],
+        env={"DATAVAULT_SECRET": datavault_secret},
+    )
+    assert result.exit_code == 0
+    assert not {"test1.txt", "test2.txt"} & snapshot(vault.root_path)
 
-        # Ensure the files are encrypted
-        assert os.path.exists(Path(vault.encrypted_path) / "test1.txt")
-        assert os.path.exists(Path(vault.encrypted_path) / "test2.txt")
+    changes = vault.changes()
 
-        result = runner.invoke(
-            cli.main,
-            ["clear-decrypted", "-f", path],
-            env={"DATAVAULT_SECRET": DATAVAULT_SECRET},
-        )
-        assert result.exit_code == 0
-        assert not os.path.exists(Path(vault.root_path) / "test1.txt")
-        assert not os.path.exists(Path(vault.root_path) / "test2.txt")
+    assert changes["total"] == 2
+    assert list(sorted(changes["deletions"])) == ["test1.txt", "test2.txt"]
 
-        changes = vault.changes()
+    result = runner.invoke(
+        cli.main,
+        ["clear-encrypted", path, "--force"],
+        env={"DATAVAULT_SECRET": datavault_secret},
+    )
 
-        assert changes["total"] == 2
-        assert list(sorted(changes["deletions"])) == ["test1.txt", "test2.txt"]
+    changes = vault.changes()
+    assert changes["total"] == 0
+    assert changes["deletions"] == []
 
-        result = runner.invoke(
-            cli.main,
-            ["clear-encrypted", path, "--force"],
-            env={"DATAVAULT_SECRET": DATAVAULT_SECRET},
-        )
 
-        changes = vault.changes()
-        assert changes["total"] == 0
-        assert changes["deletions"] == []
+def test_cli_v1_vault(v1_vault, v1_secret):
+    runner = CliRunner()
+    path = str(v1_vault.root_path)
+
+    result = runner.invoke(cli.main, ["inspect", path])
+    assert result.exit_code == 0
+    assert "uses the old manifest v1" in result.output
+
+    result = runner.invoke(
+        cli.main, ["decrypt", "-f", path], env={"DATAVAULT_SECRET": v1_secret}
+    )
+    assert result.exit_code == 0
+    assert (v1_vault.root_path / "secret.txt").read_text() == "v1 secret\n"
+
+    # Encrypting upgrades the vault even though nothing changed
+    result = runner.invoke(
+        cli.main, ["encrypt", path], env={"DATAVAULT_SECRET": v1_secret}
+    )
+    assert result.exit_code == 0
+    assert v1_vault.version() == DataVault.VERSION
+
+    result = runner.invoke(cli.main, ["inspect", path])
+    assert result.exit_code == 0
+    assert "uses the old manifest" not in result.output
+
+    # Bump the version past what this release supports
+    manifest = load_manifest(v1_vault)
+    manifest["version"] = 99
+    Path(v1_vault.vault_manifest_path).write_text(json.dumps(manifest))
+
+    result = runner.invoke(cli.main, ["inspect", path])
+    assert result.exit_code == 1
+    assert "uses manifest v99" in result.output
+
+
+def test_cli_force_decrypt(fresh_vault, fast_crypto, tmp_path, datavault_secret):
+    runner = CliRunner()
+    vault = fresh_vault(tmp_path / "test_vault")
+    path = str(vault.root_path)
+    env = {"DATAVAULT_SECRET": datavault_secret}
+
+    (vault.root_path / "test.txt").write_text("test")
+    result = runner.invoke(cli.main, ["encrypt", path], env=env)
+    assert result.exit_code == 0
+
+    # Edit the file without changing its size or modification time
+    st = os.stat(vault.root_path / "test.txt")
+    (vault.root_path / "test.txt").write_text("best")
+    os.utime(vault.root_path / "test.txt", ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    result = runner.invoke(cli.main, ["decrypt", path], env=env)
+    assert result.exit_code == 0
+    assert (vault.root_path / "test.txt").read_text() == "best"
+
+    result = runner.invoke(cli.main, ["decrypt", "--rehash", path], env=env)
+    assert "This vault has changes." in result.output
+    assert (vault.root_path / "test.txt").read_text() == "best"
+
+    result = runner.invoke(cli.main, ["decrypt", "-f", path], env=env)
+    assert result.exit_code == 0
+    assert (vault.root_path / "test.txt").read_text() == "test"
+
+
+def test_cli_hashes_once(
+    fresh_vault, fast_crypto, tmp_path, monkeypatch, datavault_secret
+):
+    runner = CliRunner()
+    vault = fresh_vault(tmp_path / "test_vault")
+    path = str(vault.root_path)
+    env = {"DATAVAULT_SECRET": datavault_secret}
+
+    (vault.root_path / "test1.txt").write_text("test1")
+    (vault.root_path / "test2.txt").write_text("test2")
+
+    hash_for_file = dihi_datavault.hash_for_file
+    hashed = []
+
+    def counting_hash_for_file(path):
+        hashed.append(Path(path).name)
+        return hash_for_file(path)
+
+    monkeypatch.setattr(dihi_datavault, "hash_for_file", counting_hash_for_file)
+
+    result = runner.invoke(cli.main, ["encrypt", "--rehash", path], env=env)
+    assert result.exit_code == 0
+    assert sorted(hashed) == ["test1.txt", "test2.txt"]
+
+    hashed.clear()
+    result = runner.invoke(cli.main, ["decrypt", "--rehash", path], env=env)
+    assert result.exit_code == 0
+    assert sorted(hashed) == ["test1.txt", "test2.txt"]